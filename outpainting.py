@@ -1,50 +1,140 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections.abc import Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 
-import requests
-from openai import OpenAI
+import httpx
+import openai
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI
 from PIL import Image
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 from tqdm import tqdm
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-class OpenAIOutpainting:
-    def __init__(self, size: int = 1024, percentage: float = 0.2):
-        self._client = OpenAI()
+retry_on_transient_errors = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(
+        (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        )
+    ),
+    reraise=True,
+)
+
+
+class OutpaintingImageProcessor:
+    def __init__(
+        self,
+        size: int = 1024,
+        percentage: float = 0.2,
+        max_pooled_images: int = 4,
+    ):
         self._size = size
         self._percentage = percentage
 
+        self._max_pooled_images = max_pooled_images
+        self._canvas_pool: list[Image.Image] = []
+        self._canvas_pool_lock = threading.Lock()
+
     def load_image(
         self,
         image_path: str | Path,
         desired_height: int = 1024,
     ) -> Image.Image:
         image = Image.open(image_path)
+        draft_width = math.ceil(image.width * desired_height / image.height)
+        image.draft("RGB", (draft_width, desired_height))
         image = self._resize_image_with_proportions(image, height=desired_height)
         return image
 
+    def _fits_packing_cell(self, size: tuple[int, int]) -> bool:
+        width, height = size
+        cell_size = self._size // 2
+        padded_width = int(width * (1 + self._percentage * 2))
+        return padded_width <= cell_size and height <= cell_size
+
+    def is_packable(self, image_path: str | Path) -> bool:
+        with Image.open(image_path) as image:
+            return self._fits_packing_cell(image.size)
+
+    def load_packable_image(self, image_path: str | Path) -> Image.Image:
+        with Image.open(image_path) as image:
+            return image.convert("RGB")
+
     def _resize_image_with_proportions(
         self, image: Image.Image, width: int | None = None, height: int | None = None
     ) -> Image.Image:
         if width and height:
-            image = image.resize((width, height))
+            image = image.resize((width, height), resample=Image.Resampling.BILINEAR)
         elif width:
             ratio = width / float(image.size[0])
             height = int(float(image.size[1]) * float(ratio))
-            image = image.resize((width, height))
+            image = image.resize((width, height), resample=Image.Resampling.BILINEAR)
         elif height:
             ratio = height / float(image.size[1])
             width = int(float(image.size[0]) * float(ratio))
-            image = image.resize((width, height))
+            image = image.resize((width, height), resample=Image.Resampling.BILINEAR)
         return image
 
+    def _acquire_canvas(
+        self,
+        mode: str,
+        size: tuple[int, int],
+        color: tuple[int, ...] | None = None,
+    ) -> Image.Image:
+        canvas = None
+        with self._canvas_pool_lock:
+            for index in range(len(self._canvas_pool) - 1, -1, -1):
+                pooled_canvas = self._canvas_pool[index]
+                if pooled_canvas.mode == mode and pooled_canvas.size == size:
+                    canvas = self._canvas_pool.pop(index)
+                    break
+
+        if canvas is None:
+            return Image.new(mode, size, color or 0)
+
+        if color is not None:
+            canvas.paste(color, (0, 0, *size))
+        return canvas
+
+    def release_image(self, image: Image.Image) -> None:
+        with self._canvas_pool_lock:
+            self._canvas_pool.append(image)
+            if len(self._canvas_pool) > self._max_pooled_images:
+                self._canvas_pool.pop(0)
+
     def _prepare_image(
         self,
         image: Image.Image,
         percentage: float = 0.2,
     ) -> Image.Image:
-        image = image.convert("RGBA")
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
         factor = 1 + percentage * 2
-        new_image = Image.new(
+        new_image = self._acquire_canvas(
             "RGBA", (int(image.width * factor), image.height), (0, 0, 0, 0)
         )
         new_image.paste(image, (int(image.width * percentage), 0))
@@ -59,81 +149,774 @@ class OpenAIOutpainting:
         right_image = image.crop((half_width, 0, width, size[1]))
         return left_image, right_image
 
-    def _convert_image_to_bytes(self, image: Image.Image) -> bytes:
+    def convert_image_to_bytes(self, image: Image.Image) -> bytes:
         with BytesIO() as output:
-            image.save(output, format="PNG")
+            image.save(output, format="PNG", compress_level=1, optimize=False)
             return output.getvalue()
 
-    def _outpaint_image(
-        self,
-        image: Image.Image,
-        model: str = "dall-e-2",
-    ) -> str:
-        image_bytes = self._convert_image_to_bytes(image)
-        openai_size = f"{self._size}x{self._size}"
-        response = self._client.images.edit(
-            model=model,
-            image=image_bytes,
-            prompt=" ",
-            n=1,
-            size=openai_size,
-        )
-        image_url = response.data[0].url
-        return image_url
-
     def _combine_images(
         self,
         original_image: Image.Image,
-        left_image: Image.Image,
-        right_image: Image.Image,
+        left_image: Image.Image | None,
+        right_image: Image.Image | None,
     ) -> Image.Image:
         width, _ = original_image.size
         width_right_start = width - self._size
-        original_image.paste(left_image, (0, 0))
-        original_image.paste(right_image, (width_right_start, 0))
+        if left_image is not None:
+            original_image.paste(left_image, (0, 0))
+        if right_image is not None:
+            original_image.paste(right_image, (width_right_start, 0))
         return original_image
 
-    def perform_outpainting(
+    def prepare_canvas(self, image: Image.Image) -> Image.Image:
+        return self._prepare_image(image, percentage=self._percentage)
+
+    def decode_image(self, image_bytes: bytes) -> Image.Image:
+        image = Image.open(BytesIO(image_bytes))
+        image.load()
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        return image
+
+    def prepare_crops(
         self,
         image: Image.Image,
-    ) -> Image.Image:
-        image_with_padding = self._prepare_image(image, percentage=self._percentage)
+    ) -> tuple[Image.Image, Image.Image | None, Image.Image | None]:
+        image_with_padding = self.prepare_canvas(image)
+        left_padding = int(image.width * self._percentage)
+        right_padding = image_with_padding.width - image.width - left_padding
 
         left_image, right_image = self._split_image(
             image_with_padding, size=(self._size, self._size)
         )
 
-        left_image_url = self._outpaint_image(left_image, model="dall-e-2")
-        right_image_url = self._outpaint_image(right_image, model="dall-e-2")
+        return (
+            image_with_padding,
+            left_image if left_padding > 0 else None,
+            right_image if right_padding > 0 else None,
+        )
+
+    def finalize_image(
+        self,
+        image_with_padding: Image.Image,
+        left_image: Image.Image | None,
+        right_image: Image.Image | None,
+    ) -> Image.Image:
+        combined_image = self._combine_images(
+            image_with_padding, left_image, right_image
+        )
+        final_image = Image.new("RGB", combined_image.size)
+        final_image.paste(combined_image)
+        self.release_image(combined_image)
+        return final_image
+
+    def prepare_uploads(
+        self,
+        image: Image.Image,
+    ) -> tuple[Image.Image, bytes | None, bytes | None]:
+        image_with_padding, left_image, right_image = self.prepare_crops(image)
+        left_bytes = (
+            self.convert_image_to_bytes(left_image) if left_image is not None else None
+        )
+        right_bytes = (
+            self.convert_image_to_bytes(right_image)
+            if right_image is not None
+            else None
+        )
+        return image_with_padding, left_bytes, right_bytes
+
+    def pack_images(
+        self,
+        images: list[Image.Image],
+    ) -> tuple[Image.Image, list[tuple[int, int, int, int]]]:
+        cell_size = self._size // 2
+        if len(images) > 4:
+            raise ValueError(f"At most 4 images fit on one canvas, got {len(images)}")
+        for image in images:
+            if not self._fits_packing_cell(image.size):
+                raise ValueError(
+                    f"Image of size {image.size} does not fit a {cell_size}px cell"
+                )
+
+        packed_image = self._acquire_canvas(
+            "RGBA", (self._size, self._size), (0, 0, 0, 0)
+        )
+        boxes = []
+        for index, image in enumerate(images):
+            image_with_padding = self._prepare_image(image, percentage=self._percentage)
+            left = (index % 2) * cell_size
+            top = (index // 2) * cell_size
+            packed_image.paste(image_with_padding, (left, top))
+            boxes.append(
+                (
+                    left,
+                    top,
+                    left + image_with_padding.width,
+                    top + image_with_padding.height,
+                )
+            )
+            self.release_image(image_with_padding)
+
+        return packed_image, boxes
+
+    def unpack_images(
+        self,
+        packed_image: Image.Image,
+        boxes: list[tuple[int, int, int, int]],
+    ) -> list[Image.Image]:
+        return [packed_image.crop(box).convert("RGB") for box in boxes]
+
+
+class OpenAIOutpainting:
+    def __init__(
+        self,
+        size: int = 1024,
+        percentage: float = 0.2,
+        max_concurrency: int = 10,
+        max_requests_per_minute: int = 50,
+        cache_dir: str | Path | None = None,
+        decode_executor: Executor | None = None,
+        http_client: httpx.AsyncClient | None = None,
+    ):
+        self._client = AsyncOpenAI(
+            http_client=http_client,
+            max_retries=0,
+            timeout=httpx.Timeout(600, connect=5),
+        )
+        self._size = size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._rpm_limiter = AsyncLimiter(
+            max_rate=max_requests_per_minute, time_period=60
+        )
+
+        self._cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self._cache_dir is not None:
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._image_processor = OutpaintingImageProcessor(
+            size=size, percentage=percentage
+        )
+        self._decode_executor = decode_executor
+
+    def load_image(
+        self,
+        image_path: str | Path,
+        desired_height: int = 1024,
+    ) -> Image.Image:
+        return self._image_processor.load_image(image_path, desired_height)
+
+    def is_packable(self, image_path: str | Path) -> bool:
+        return self._image_processor.is_packable(image_path)
+
+    def load_packable_image(self, image_path: str | Path) -> Image.Image:
+        return self._image_processor.load_packable_image(image_path)
+
+    def release_image(self, image: Image.Image) -> None:
+        self._image_processor.release_image(image)
+
+    @retry_on_transient_errors
+    async def _request_outpainting(
+        self,
+        image_bytes: bytes,
+        prompt: str,
+        model: str = "dall-e-2",
+    ) -> str:
+        openai_size = f"{self._size}x{self._size}"
+        async with self._semaphore, self._rpm_limiter:
+            response = await self._client.images.edit(
+                model=model,
+                image=image_bytes,
+                prompt=prompt,
+                n=1,
+                size=openai_size,
+                response_format="b64_json",
+            )
+        image_base64 = response.data[0].b64_json
+        return image_base64
+
+    def _get_cache_key(self, image_bytes: bytes, prompt: str, model: str) -> str:
+        key = hashlib.sha256(f"{model}:{self._size}:{prompt}:".encode())
+        key.update(image_bytes)
+        return key.hexdigest()
+
+    def _write_cache_file(self, cache_path: Path, data: bytes) -> None:
+        with tempfile.NamedTemporaryFile(
+            dir=cache_path.parent, suffix=".tmp", delete=False
+        ) as temporary_file:
+            temporary_file.write(data)
+        Path(temporary_file.name).replace(cache_path)
+
+    async def _outpaint_image(
+        self,
+        image_bytes: bytes,
+        prompt: str = " ",
+        model: str = "dall-e-2",
+    ) -> bytes:
+        cache_path = None
+        if self._cache_dir is not None:
+            cache_key = self._get_cache_key(image_bytes, prompt=prompt, model=model)
+            cache_path = self._cache_dir / f"{cache_key}.png"
+            if cache_path.exists():
+                return await asyncio.to_thread(cache_path.read_bytes)
+
+        image_base64 = await self._request_outpainting(
+            image_bytes, prompt=prompt, model=model
+        )
+        result_bytes = base64.b64decode(image_base64)
+
+        if cache_path is not None:
+            await asyncio.to_thread(self._write_cache_file, cache_path, result_bytes)
+
+        return result_bytes
+
+    async def _decode_result(self, image_bytes: bytes | None) -> Image.Image | None:
+        if image_bytes is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._decode_executor, self._image_processor.decode_image, image_bytes
+        )
+
+    async def _outpaint_padding(
+        self,
+        image_bytes: bytes | None,
+        model: str = "dall-e-2",
+    ) -> bytes | None:
+        if image_bytes is None:
+            return None
+
+        return await self._outpaint_image(image_bytes, model=model)
+
+    async def outpaint_crops(
+        self,
+        left_bytes: bytes | None,
+        right_bytes: bytes | None,
+    ) -> tuple[bytes | None, bytes | None]:
+        left_result, right_result = await asyncio.gather(
+            self._outpaint_padding(left_bytes, model="dall-e-2"),
+            self._outpaint_padding(right_bytes, model="dall-e-2"),
+        )
+        return left_result, right_result
+
+    async def perform_outpainting(
+        self,
+        image: Image.Image,
+    ) -> Image.Image:
+        image_with_padding, left_bytes, right_bytes = await asyncio.to_thread(
+            self._image_processor.prepare_uploads, image
+        )
 
-        left_image_bytes = requests.get(left_image_url).content
-        right_image_bytes = requests.get(right_image_url).content
-        left_image = Image.open(BytesIO(left_image_bytes))
-        right_image = Image.open(BytesIO(right_image_bytes))
+        left_result, right_result = await self.outpaint_crops(left_bytes, right_bytes)
+        left_image, right_image = await asyncio.gather(
+            self._decode_result(left_result), self._decode_result(right_result)
+        )
 
-        final_image = self._combine_images(image_with_padding, left_image, right_image)
-        final_image = final_image.convert("RGB")
+        final_image = await asyncio.to_thread(
+            self._image_processor.finalize_image,
+            image_with_padding,
+            left_image,
+            right_image,
+        )
 
         return final_image
 
+    async def perform_packed_outpainting(
+        self,
+        images: list[Image.Image],
+    ) -> list[Image.Image]:
+        packed_image, boxes = await asyncio.to_thread(
+            self._image_processor.pack_images, images
+        )
+        packed_bytes = await asyncio.to_thread(
+            self._image_processor.convert_image_to_bytes, packed_image
+        )
+        self.release_image(packed_image)
 
-if __name__ == "__main__":
-    client = OpenAI()
+        result_bytes = await self._outpaint_image(packed_bytes, model="dall-e-2")
+        outpainted_image = await self._decode_result(result_bytes)
+
+        return await asyncio.to_thread(
+            self._image_processor.unpack_images, outpainted_image, boxes
+        )
+
+    def _create_batch_request(
+        self,
+        custom_id: str,
+        image_bytes: bytes,
+        prompt: str = " ",
+        model: str = "gpt-image-1",
+    ) -> str:
+        image_url = f"data:image/png;base64,{base64.b64encode(image_bytes).decode()}"
+        request = {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/images/edits",
+            "body": {
+                "model": model,
+                "images": [{"image_url": image_url}],
+                "mask": {"image_url": image_url},
+                "prompt": prompt,
+                "n": 1,
+                "size": f"{self._size}x{self._size}",
+            },
+        }
+        return json.dumps(request)
+
+    async def _create_batch(self, batch_requests: list[str]) -> str:
+        batch_file = await self._client.files.create(
+            file=("outpainting_batch.jsonl", "\n".join(batch_requests).encode()),
+            purpose="batch",
+        )
+        batch = await self._client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/images/edits",
+            completion_window="24h",
+        )
+        return batch.id
+
+    async def submit_batch(
+        self,
+        image_paths: list[Path],
+        model: str = "gpt-image-1",
+        max_batch_file_size: int = 190 * 1024 * 1024,
+    ) -> list[str]:
+        batch_ids = []
+        batch_requests: list[str] = []
+        batch_file_size = 0
+        for image_path in image_paths:
+            image = await asyncio.to_thread(
+                self.load_image, image_path, desired_height=self._size
+            )
+            image_with_padding, left_bytes, right_bytes = await asyncio.to_thread(
+                self._image_processor.prepare_uploads, image
+            )
+            self.release_image(image_with_padding)
+
+            image_requests = []
+            for side, crop in (("left", left_bytes), ("right", right_bytes)):
+                if crop is not None:
+                    request = await asyncio.to_thread(
+                        self._create_batch_request,
+                        f"{image_path.stem}-{side}",
+                        crop,
+                        model=model,
+                    )
+                    image_requests.append(request)
+
+            image_requests_size = sum(len(request) + 1 for request in image_requests)
+            if (
+                batch_requests
+                and batch_file_size + image_requests_size > max_batch_file_size
+            ):
+                batch_ids.append(await self._create_batch(batch_requests))
+                batch_requests, batch_file_size = [], 0
+
+            batch_requests.extend(image_requests)
+            batch_file_size += image_requests_size
+
+        if batch_requests:
+            batch_ids.append(await self._create_batch(batch_requests))
+
+        return batch_ids
+
+    def _read_batch_result(self, results: dict[str, dict], custom_id: str) -> bytes:
+        result = results.get(custom_id)
+        if result is None:
+            raise RuntimeError(f"Batch request {custom_id} has no result")
+
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            raise RuntimeError(
+                f"Batch request {custom_id} failed: "
+                f"{result.get('error') or response.get('body')}"
+            )
+
+        image_base64 = response["body"]["data"][0]["b64_json"]
+        return base64.b64decode(image_base64)
+
+    async def _read_batch_file(self, file_id: str | None) -> dict[str, dict]:
+        if file_id is None:
+            return {}
+
+        output = await self._client.files.content(file_id)
+        results = {}
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            results[result["custom_id"]] = result
+        return results
+
+    async def _wait_for_batch_results(
+        self,
+        batch_id: str,
+        poll_interval: float = 60,
+    ) -> dict[str, dict]:
+        batch = await self._client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(poll_interval)
+            batch = await self._client.batches.retrieve(batch_id)
+
+        if batch.status != "completed":
+            print(f"Batch {batch_id} finished with status {batch.status}")
+
+        results = await self._read_batch_file(batch.error_file_id)
+        results.update(await self._read_batch_file(batch.output_file_id))
+        return results
+
+    async def _save_batch_image(
+        self,
+        image_path: Path,
+        results: dict[str, dict],
+        result_path: Path,
+    ) -> None:
+        image = await asyncio.to_thread(
+            self.load_image, image_path, desired_height=self._size
+        )
+        image_with_padding, left_image, right_image = await asyncio.to_thread(
+            self._image_processor.prepare_crops, image
+        )
+
+        results_bytes = []
+        for side, crop in (("left", left_image), ("right", right_image)):
+            if crop is None:
+                results_bytes.append(None)
+                continue
+            try:
+                results_bytes.append(
+                    self._read_batch_result(results, f"{image_path.stem}-{side}")
+                )
+            except RuntimeError as error:
+                print(f"Skipping {image_path.name}: {error}")
+                self.release_image(image_with_padding)
+                return
+
+        outpainted_images = await asyncio.gather(
+            *(self._decode_result(result_bytes) for result_bytes in results_bytes)
+        )
+
+        final_image = await asyncio.to_thread(
+            self._image_processor.finalize_image,
+            image_with_padding,
+            *outpainted_images,
+        )
+        await asyncio.to_thread(final_image.save, result_path)
+
+    async def collect_batch(
+        self,
+        batch_ids: list[str],
+        image_paths: list[Path],
+        result_folder: Path,
+        poll_interval: float = 60,
+    ) -> None:
+        for batch_id in batch_ids:
+            results = await self._wait_for_batch_results(batch_id, poll_interval)
+            batch_stems = {custom_id.rsplit("-", 1)[0] for custom_id in results}
 
+            for image_path in image_paths:
+                if image_path.stem in batch_stems:
+                    await self._save_batch_image(
+                        image_path, results, result_folder / f"{image_path.stem}.jpg"
+                    )
+
+
+_worker_image_processor: OutpaintingImageProcessor | None = None
+
+
+def _init_image_worker(size: int, percentage: float) -> None:
+    global _worker_image_processor
+    _worker_image_processor = OutpaintingImageProcessor(
+        size=size, percentage=percentage
+    )
+
+
+def _prepare_image_file(
+    image_path: Path, desired_height: int
+) -> tuple[bytes, bytes | None, bytes | None]:
+    assert _worker_image_processor is not None
+
+    image = _worker_image_processor.load_image(image_path, desired_height)
+    image_with_padding, left_bytes, right_bytes = (
+        _worker_image_processor.prepare_uploads(image)
+    )
+    canvas_bytes = _worker_image_processor.convert_image_to_bytes(image_with_padding)
+    _worker_image_processor.release_image(image_with_padding)
+    return canvas_bytes, left_bytes, right_bytes
+
+
+def _save_image_file(
+    canvas_bytes: bytes,
+    left_bytes: bytes | None,
+    right_bytes: bytes | None,
+    result_path: Path,
+) -> None:
+    assert _worker_image_processor is not None
+
+    image_with_padding = _worker_image_processor.decode_image(canvas_bytes)
+    left_image = (
+        _worker_image_processor.decode_image(left_bytes) if left_bytes else None
+    )
+    right_image = (
+        _worker_image_processor.decode_image(right_bytes) if right_bytes else None
+    )
+
+    final_image = _worker_image_processor.finalize_image(
+        image_with_padding, left_image, right_image
+    )
+    final_image.save(result_path)
+
+
+async def decode_worker(
+    image_paths: Iterator[Path],
+    prepared_queue: asyncio.Queue,
+    executor: Executor,
+    size: int,
+) -> None:
+    loop = asyncio.get_running_loop()
+    for image_path in image_paths:
+        prepared = await loop.run_in_executor(
+            executor, _prepare_image_file, image_path, size
+        )
+        await prepared_queue.put((image_path, *prepared))
+
+
+async def api_worker(
+    openai_outpainting: OpenAIOutpainting,
+    prepared_queue: asyncio.Queue,
+    outpainted_queue: asyncio.Queue,
+) -> None:
+    while (item := await prepared_queue.get()) is not None:
+        image_path, canvas_bytes, left_bytes, right_bytes = item
+        left_result, right_result = await openai_outpainting.outpaint_crops(
+            left_bytes, right_bytes
+        )
+        await outpainted_queue.put(
+            (image_path, canvas_bytes, left_result, right_result)
+        )
+
+
+async def encode_worker(
+    outpainted_queue: asyncio.Queue,
+    executor: Executor,
+    result_folder: Path,
+    progress_bar: tqdm,
+) -> None:
+    loop = asyncio.get_running_loop()
+    while (item := await outpainted_queue.get()) is not None:
+        image_path, canvas_bytes, left_result, right_result = item
+        await loop.run_in_executor(
+            executor,
+            _save_image_file,
+            canvas_bytes,
+            left_result,
+            right_result,
+            result_folder / f"{image_path.stem}.jpg",
+        )
+        progress_bar.update()
+
+
+async def run_pipeline(
+    openai_outpainting: OpenAIOutpainting,
+    image_paths: list[Path],
+    result_folder: Path,
+    size: int,
+    percentage: float,
+    num_api_workers: int,
+    num_cpu_workers: int | None = None,
+    queue_size: int = 4,
+) -> None:
+    num_cpu_workers = num_cpu_workers or os.cpu_count() or 1
+    prepared_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    outpainted_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    image_paths_iterator = iter(image_paths)
+
+    with (
+        ProcessPoolExecutor(
+            max_workers=num_cpu_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_image_worker,
+            initargs=(size, percentage),
+        ) as executor,
+        tqdm(total=len(image_paths), postfix="Outpainting...") as progress_bar,
+    ):
+        async with asyncio.TaskGroup() as task_group:
+            decode_tasks = [
+                task_group.create_task(
+                    decode_worker(
+                        image_paths_iterator, prepared_queue, executor, size=size
+                    )
+                )
+                for _ in range(num_cpu_workers)
+            ]
+            api_tasks = [
+                task_group.create_task(
+                    api_worker(openai_outpainting, prepared_queue, outpainted_queue)
+                )
+                for _ in range(num_api_workers)
+            ]
+            encode_tasks = [
+                task_group.create_task(
+                    encode_worker(
+                        outpainted_queue,
+                        executor,
+                        result_folder,
+                        progress_bar,
+                    )
+                )
+                for _ in range(num_cpu_workers)
+            ]
+
+            await asyncio.gather(*decode_tasks)
+            for _ in api_tasks:
+                await prepared_queue.put(None)
+
+            await asyncio.gather(*api_tasks)
+            for _ in encode_tasks:
+                await outpainted_queue.put(None)
+
+
+async def pack_worker(
+    openai_outpainting: OpenAIOutpainting,
+    image_groups: Iterator[list[Path]],
+    result_folder: Path,
+    progress_bar: tqdm,
+) -> None:
+    for image_group in image_groups:
+        images = await asyncio.gather(
+            *(
+                asyncio.to_thread(openai_outpainting.load_packable_image, image_path)
+                for image_path in image_group
+            )
+        )
+        outpainted_images = await openai_outpainting.perform_packed_outpainting(
+            list(images)
+        )
+        for image_path, outpainted_image in zip(image_group, outpainted_images):
+            await asyncio.to_thread(
+                outpainted_image.save, result_folder / f"{image_path.stem}.jpg"
+            )
+        progress_bar.update(len(image_group))
+
+
+async def run_packed_pipeline(
+    openai_outpainting: OpenAIOutpainting,
+    image_paths: list[Path],
+    result_folder: Path,
+    num_workers: int,
+) -> None:
+    image_groups = iter(
+        [image_paths[index : index + 4] for index in range(0, len(image_paths), 4)]
+    )
+
+    with tqdm(total=len(image_paths), postfix="Outpainting...") as progress_bar:
+        async with asyncio.TaskGroup() as task_group:
+            for _ in range(num_workers):
+                task_group.create_task(
+                    pack_worker(
+                        openai_outpainting, image_groups, result_folder, progress_bar
+                    )
+                )
+
+
+async def main(
+    pack: bool = False,
+    batch: bool = False,
+    collect_batch_ids: list[str] | None = None,
+) -> None:
     image_folder = Path("./images")
     result_folder = Path("./results")
+    packed_result_folder = Path("./results_packed")
+    cache_folder = Path("./cache")
 
-    image_paths = list(image_folder.glob("*.jpg"))
+    image_paths = sorted(image_folder.glob("*.jpg"))
 
     size = 1024
     percentage = 0.3
+    max_concurrency = 10
+    max_requests_per_minute = 50
 
-    openai_outpainting = OpenAIOutpainting(size=size, percentage=percentage)
+    http_limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
 
-    for image_path in tqdm(image_paths, postfix="Outpainting..."):
-        image = openai_outpainting.load_image(image_path, desired_height=size)
-        final_image = openai_outpainting.perform_outpainting(
-            image=image,
-        )
+    with ThreadPoolExecutor(max_workers=4) as decode_executor:
+        async with httpx.AsyncClient(limits=http_limits) as http_client:
+            openai_outpainting = OpenAIOutpainting(
+                http_client=http_client,
+                size=size,
+                percentage=percentage,
+                max_concurrency=max_concurrency,
+                max_requests_per_minute=max_requests_per_minute,
+                cache_dir=cache_folder,
+                decode_executor=decode_executor,
+            )
+
+            if batch or collect_batch_ids:
+                batch_ids = collect_batch_ids
+                if not batch_ids:
+                    batch_ids = await openai_outpainting.submit_batch(image_paths)
+                    print(
+                        "Submitted batches, resume with: "
+                        f"--collect {' '.join(batch_ids)}"
+                    )
+
+                await openai_outpainting.collect_batch(
+                    batch_ids, image_paths, result_folder
+                )
+                return
+
+            if pack:
+                packable_paths = [
+                    image_path
+                    for image_path in image_paths
+                    if openai_outpainting.is_packable(image_path)
+                ]
+                packed_result_folder.mkdir(exist_ok=True)
+                await run_packed_pipeline(
+                    openai_outpainting,
+                    packable_paths,
+                    packed_result_folder,
+                    num_workers=max_concurrency,
+                )
+                image_paths = [
+                    image_path
+                    for image_path in image_paths
+                    if image_path not in packable_paths
+                ]
+
+            await run_pipeline(
+                openai_outpainting,
+                image_paths,
+                result_folder,
+                size=size,
+                percentage=percentage,
+                num_api_workers=max_concurrency,
+            )
 
-        final_image.save(result_folder / f"{image_path.stem}.jpg")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Outpaint images that fit a quarter canvas 4 per request into "
+        "./results_packed, the rest one by one",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Outpaint all images through Batch API jobs (cheaper, up to 24h)",
+    )
+    parser.add_argument(
+        "--collect",
+        nargs="+",
+        metavar="BATCH_ID",
+        help="Wait for previously submitted batches and save their results",
+    )
+    args = parser.parse_args()
+
+    if uvloop is not None:
+        uvloop.run(
+            main(pack=args.pack, batch=args.batch, collect_batch_ids=args.collect)
+        )
+    else:
+        asyncio.run(
+            main(pack=args.pack, batch=args.batch, collect_batch_ids=args.collect)
+        )